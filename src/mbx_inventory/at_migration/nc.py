@@ -1,81 +1,213 @@
 from mbx_inventory.schemas import BaseSchema, Column, TABLES
-from mbx_inventory.create_db_schema import check_resp_status_code
-from mesonet_in_a_box.config import Config
+from mbx_inventory.create_db_schema import MAX_CONCURRENCY, check_resp_status_code
+import atexit
+import functools
 import httpx
+import itertools
+import logging
+import math
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-
-base_schema = BaseSchema.load(
-    Path("/Users/Colin.Brust/.config/mbx/pg8vslwpxt0pqvk.json")
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+# NocoDB's maximum page size for GET /records.
+PAGE_SIZE = 1000
+# Transient failures worth retrying rather than aborting a long migration.
+RETRY_STATUS_CODES = frozenset({429, 502, 503, 504})
+RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ReadTimeout)
+# A timeout or gateway error may arrive after NocoDB has applied the request,
+# so POST and DELETE are only re-sent when it was never processed.
+IDEMPOTENT_METHODS = frozenset({"GET", "PATCH"})
+UNSENT_STATUS_CODES = frozenset({429})
+UNSENT_EXCEPTIONS = (httpx.ConnectError,)
+MAX_ATTEMPTS = 6
+MAX_RETRY_DELAY = 30.0
+RETRY_DELAYS = tuple(
+    min(0.5 * 2**attempt, MAX_RETRY_DELAY) for attempt in range(MAX_ATTEMPTS)
 )
-CONFIG = Config.load(Config.file)
-
-
-def get_table_records(
-    table_id, params: dict | None = None, content: list | None = None
-):
-    if params is None:
-        params = {}
-    if content is None:
-        content = []
-
-    while True:
-        resp = httpx.get(
-            f"{CONFIG.nocodb_url}/api/v2/tables/{table_id}/records",
-            headers={
-                "xc-token": CONFIG.nocodb_token,
-                "Content-Type": "application/json",
-            },
-            params=params,
-        )
 
-        check_resp_status_code(resp)
-        resp = resp.json()
-        if len(data := resp.get("list", [])) > 0:
-            content.extend(data)
 
-        if not resp["pageInfo"].get("isLastPage", True):
-            offset = resp["pageInfo"]["pageSize"] * resp["pageInfo"].get("page", 1)
-            params["offset"] = offset
+def retry_delay(attempt: int, resp: httpx.Response | None = None) -> float:
+    if resp is not None:
+        try:
+            delay = float(resp.headers["Retry-After"])
+        except (KeyError, ValueError):
+            pass
         else:
-            break
-    return content
+            if math.isfinite(delay):
+                return min(max(0.0, delay), MAX_RETRY_DELAY)
+    return RETRY_DELAYS[attempt] * random.uniform(0.5, 1.0)
 
 
-def delete_table(table_id):
-    resp = httpx.delete(
-        f"{CONFIG.nocodb_url}/api/v2/meta/tables/{table_id}",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
+class RetryTransport(httpx.HTTPTransport):
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method in IDEMPOTENT_METHODS:
+            retry_exceptions = RETRY_EXCEPTIONS
+            retry_status_codes = RETRY_STATUS_CODES
+        else:
+            retry_exceptions = UNSENT_EXCEPTIONS
+            retry_status_codes = UNSENT_STATUS_CODES
+
+        for attempt in range(MAX_ATTEMPTS - 1):
+            try:
+                resp = super().handle_request(request)
+            except retry_exceptions as e:
+                reason, delay = type(e).__name__, retry_delay(attempt)
+            else:
+                if resp.status_code not in retry_status_codes:
+                    return resp
+                resp.close()
+                reason, delay = resp.status_code, retry_delay(attempt, resp)
+            logger.warning(
+                "%s %s failed (%s), retrying in %.1fs",
+                request.method,
+                request.url,
+                reason,
+                delay,
+            )
+            time.sleep(delay)
+
+        return super().handle_request(request)
+
+
+@functools.cache
+def get_base_schema() -> BaseSchema:
+    path = os.environ.get("MBX_SCHEMA_PATH", Path.home() / ".config/mbx/schema.json")
+    return BaseSchema.load(Path(path))
+
+
+@functools.cache
+def get_config():
+    from mesonet_in_a_box.config import Config
+
+    return Config.load(Config.file)
+
+
+@functools.cache
+def get_client() -> httpx.Client:
+    config = get_config()
+    client = httpx.Client(
+        base_url=config.nocodb_url,
+        headers={"xc-token": config.nocodb_token, "Content-Type": "application/json"},
+        transport=RetryTransport(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+        ),
+        timeout=30.0,
     )
+    atexit.register(client.close)
+    return client
+
+
+@functools.cache
+def get_executor() -> ThreadPoolExecutor:
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+    atexit.register(executor.shutdown)
+    return executor
+
+
+def send_request(client, method, url, kwargs) -> httpx.Response:
+    resp = client.request(method, url, **kwargs)
+    return check_resp_status_code(resp)
+
+
+def submit_concurrently(requests) -> Iterator[httpx.Response]:
+    # httpx.Client is thread-safe, so every worker shares its connection pool.
+    # Resolve it on this thread so the first, uncached call cannot race.
+    # All requests are submitted immediately; responses are yielded in order.
+    client = get_client()
+    return get_executor().map(lambda request: send_request(client, *request), requests)
+
+
+def send_concurrently(requests) -> list[httpx.Response]:
+    return list(submit_concurrently(requests))
+
+
+def iter_table_records(table_id, params: dict | None = None):
+    # Callers write back to the table while paging through it, so offsets
+    # need an order that updates cannot shuffle; default to the primary key.
+    params = {"sort": "Id", **(params or {})}
+
+    url = f"/api/v2/tables/{table_id}/records"
+    resp = get_client().get(url, params=params)
+    check_resp_status_code(resp)
+    resp = resp.json()
+    yield from resp.get("list", [])
+
+    page_info = resp["pageInfo"]
+    if page_info.get("isLastPage", True):
+        return
+
+    # The first page reports the total row count, so the remaining pages are
+    # independent of each other and can be fetched MAX_CONCURRENCY at a time.
+    # The next window is requested before the current one is handed to the
+    # caller, so page fetches overlap whatever the caller does with the rows
+    # while at most two windows are held in memory. This overlaps reads with
+    # the caller's writes to the same table, which is only safe because the
+    # pages follow the sort set above.
+    page_size = page_info["pageSize"]
+    offsets = range(
+        params.get("offset", 0) + page_size, page_info["totalRows"], page_size
+    )
+    pages = iter(())
+    for start in range(0, len(offsets), MAX_CONCURRENCY):
+        next_pages = submit_concurrently(
+            ("GET", url, {"params": {**params, "offset": offset}})
+            for offset in offsets[start : start + MAX_CONCURRENCY]
+        )
+        for page in pages:
+            yield from page.json().get("list", [])
+        pages = next_pages
+
+    for page in pages:
+        yield from page.json().get("list", [])
+
+
+def get_table_records(table_id, params: dict | None = None) -> list[dict]:
+    return list(iter_table_records(table_id, params))
+
+
+def delete_table(table_id):
+    resp = get_client().delete(f"/api/v2/meta/tables/{table_id}")
     check_resp_status_code(resp)
 
 
 def delete_column(column_id):
-    resp = httpx.delete(
-        f"{CONFIG.nocodb_url}/api/v2/meta/columns/{column_id}",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
-    )
+    resp = get_client().delete(f"/api/v2/meta/columns/{column_id}")
     check_resp_status_code(resp)
 
 
 def create_column(table_id, content):
-    resp = httpx.post(
-        f"{CONFIG.nocodb_url}/api/v2/meta/tables/{table_id}/columns",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
-        json=content,
-    )
+    resp = get_client().post(f"/api/v2/meta/tables/{table_id}/columns", json=content)
     check_resp_status_code(resp)
     return resp
 
 
+def bulk_patch(table_id, records):
+    url = f"/api/v2/tables/{table_id}/records"
+    records = iter(records)
+    done = 0
+    # Batches touch disjoint records, so send up to MAX_CONCURRENCY at once.
+    while window := list(itertools.islice(records, BATCH_SIZE * MAX_CONCURRENCY)):
+        send_concurrently(
+            ("PATCH", url, {"json": window[i : i + BATCH_SIZE]})
+            for i in range(0, len(window), BATCH_SIZE)
+        )
+        done += len(window)
+        logger.info("patched %d records in table %s", done, table_id)
+
+
+@functools.cache
+def keep_columns(table_name: str) -> frozenset[str]:
+    mbx_schema = BaseSchema(base_id=None, tables=TABLES)
+    return frozenset(x.column_name for x in mbx_schema[table_name].columns) | {"id_col"}
+
+
 def delete_unused_tables(base_schema):
     delete_table(base_schema["Vendors"].table_id)
     delete_table(base_schema["Bulk Inventory"].table_id)
@@ -83,8 +215,12 @@ def delete_unused_tables(base_schema):
 
 def fix_stations_table(base_schema):
     stations = base_schema["Stations"]
-    mbx_schema = BaseSchema(base_id=None, tables=TABLES)
-    delete_cols = [
+    # Later entries win, matching the search order of Table.__getitem__.
+    col_by_name = {
+        x.column_name: x
+        for x in [*stations.lookups, *stations.relationships, *stations.columns]
+    }
+    delete_cols = {
         "Outages",
         "partner_secondary",
         "local_manager",
@@ -95,16 +231,13 @@ def fix_stations_table(base_schema):
         "billing_agreements",
         "data_transfer",
         "secondary_contact",
-    ]
+    }
+    # Each column delete rewrites the table's schema, so they run one at a time.
     for column in delete_cols:
-        delete_column(stations[column].column_id)
-
-    resp = httpx.post(
-        f"{CONFIG.nocodb_url}/api/v2/meta/tables/{stations.table_id}/columns",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
+        delete_column(col_by_name[column].column_id)
+
+    resp = get_client().post(
+        f"/api/v2/meta/tables/{stations.table_id}/columns",
         json=Column(
             "id_col",
             "Formula",
@@ -118,95 +251,65 @@ def fix_stations_table(base_schema):
     target = [x for x in resp.json()["columns"] if x["column_name"] == "id_col"]
     assert len(target) == 1
 
-    resp = httpx.post(
-        f"{CONFIG.nocodb_url}/api/v2/meta/columns/{target[0]['id']}/primary",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
-    )
+    resp = get_client().post(f"/api/v2/meta/columns/{target[0]['id']}/primary")
 
-    delete_column(stations["id_1"].column_id)
+    delete_column(col_by_name["id_1"].column_id)
     create_column(stations.table_id, Column("location", "GeoData").as_dict())
+    create_column(stations.table_id, Column("extra", "JSON").as_dict())
 
-    records = get_table_records(
-        table_id=stations.table_id, params={"fields": "Id,latitude,longitude,location"}
-    )
-    for record in records:
-        record["location"] = (
-            f"{record.get('latitude', '')};{record.get('longitude', '')}"
-        )
-        resp = httpx.patch(
-            f"{CONFIG.nocodb_url}/api/v2/tables/{stations.table_id}/records",
-            headers={
-                "xc-token": CONFIG.nocodb_token,
-                "Content-Type": "application/json",
-            },
-            json=record,
-        )
-
-        check_resp_status_code(resp)
-
-    keep_cols = [x.column_name for x in mbx_schema["Stations"].columns]
-    keep_cols.extend(["id_col"])
-    roll_cols = [x for x in stations.columns if x.column_name not in keep_cols]
-    roll_cols = [x for x in roll_cols if x.column_name not in delete_cols]
-    roll_cols = [x for x in roll_cols if x.uidt != "Links"]
+    keep_cols = keep_columns("Stations")
     roll_cols = [
-        x
-        for x in roll_cols
-        if (not x.extra.get("system", False)) or (x.extra.get("system", None) is None)
+        x.column_name
+        for x in stations.columns
+        if x.column_name not in keep_cols
+        and x.column_name not in delete_cols
+        and x.uidt != "Links"
+        and not x.extra.get("system")
+        and not x.column_name.startswith("id")
     ]
-    roll_cols = [x for x in roll_cols if not x.column_name.startswith("id")]
-    roll_cols = [x.column_name for x in roll_cols]
 
-    records = get_table_records(
-        table_id=stations.table_id, params={"fields": "Id," + ",".join(roll_cols)}
+    # location and extra are both derived from the same rows, so fill them in a
+    # single read and write pass. Response size scales with fields x rows, so
+    # only request the columns that are actually read.
+    fields = dict.fromkeys(["Id", "latitude", "longitude", *roll_cols])
+    records = iter_table_records(
+        table_id=stations.table_id,
+        params={"fields": ",".join(fields), "limit": PAGE_SIZE},
     )
 
-    create_column(stations.table_id, Column("extra", "JSON").as_dict())
-
-    for record in records:
-        _id = record.pop("Id")
-        print(_id)
-        out = {"Id": _id, "extra": record}
-
-        resp = httpx.patch(
-            f"{CONFIG.nocodb_url}/api/v2/tables/{stations.table_id}/records",
-            headers={
-                "xc-token": CONFIG.nocodb_token,
-                "Content-Type": "application/json",
-            },
-            json=out,
-        )
-
-        check_resp_status_code(resp)
+    bulk_patch(
+        stations.table_id,
+        (
+            {
+                "Id": record["Id"],
+                "location": f"{record.get('latitude', '')};{record.get('longitude', '')}",
+                "extra": {k: record[k] for k in roll_cols if k in record},
+            }
+            for record in records
+        ),
+    )
 
     for column in roll_cols:
-        delete_column(stations[column].column_id)
+        delete_column(col_by_name[column].column_id)
 
 
 def fix_inventory_table(base_schema):
     inventory = base_schema["Component Inventory"]
-    mbx_schema = BaseSchema(base_id=None, tables=TABLES)
-
-    resp = httpx.patch(
-        f"{CONFIG.nocodb_url}/api/v2/meta/tables/{inventory.table_id}",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
+    # Later entries win, matching the search order of Table.__getitem__.
+    col_by_name = {
+        x.column_name: x
+        for x in [*inventory.lookups, *inventory.relationships, *inventory.columns]
+    }
+
+    resp = get_client().patch(
+        f"/api/v2/meta/tables/{inventory.table_id}",
         json={"table_name": "Inventory", "title": "Inventory"},
     )
 
     check_resp_status_code(resp)
 
-    resp = httpx.post(
-        f"{CONFIG.nocodb_url}/api/v2/meta/tables/{inventory.table_id}/columns",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
+    resp = get_client().post(
+        f"/api/v2/meta/tables/{inventory.table_id}/columns",
         json=Column(
             "id_col",
             "Formula",
@@ -222,59 +325,55 @@ def fix_inventory_table(base_schema):
     target = [x for x in resp.json()["columns"] if x["column_name"] == "id_col"]
     assert len(target) == 1
 
-    resp = httpx.post(
-        f"{CONFIG.nocodb_url}/api/v2/meta/columns/{target[0]['id']}/primary",
-        headers={
-            "xc-token": CONFIG.nocodb_token,
-            "Content-Type": "application/json",
-        },
-    )
+    resp = get_client().post(f"/api/v2/meta/columns/{target[0]['id']}/primary")
 
-    delete_column(inventory["id_1"].column_id)
+    delete_column(col_by_name["id_1"].column_id)
 
-    keep_cols = [x.column_name for x in mbx_schema["Inventory"].columns]
-    keep_cols.extend(["id_col"])
-    roll_cols = [x for x in inventory.columns if x.column_name not in keep_cols]
-    roll_cols = [x for x in roll_cols if x.uidt != "Links"]
-    roll_cols = [x for x in roll_cols if x.uidt != "Lookup"]
+    keep_cols = keep_columns("Inventory")
     roll_cols = [
-        x
-        for x in roll_cols
-        if (not x.extra.get("system", False)) or (x.extra.get("system", None) is None)
+        x.column_name
+        for x in inventory.columns
+        if x.column_name not in keep_cols
+        and x.uidt not in ("Links", "Lookup")
+        and not x.extra.get("system")
+        and not x.column_name.startswith("id")
     ]
-    roll_cols = [x for x in roll_cols if not x.column_name.startswith("id")]
-    roll_cols = [x.column_name for x in roll_cols]
 
-    records = get_table_records(
-        table_id=inventory.table_id, params={"fields": "Id," + ",".join(roll_cols)}
+    records = iter_table_records(
+        table_id=inventory.table_id,
+        params={"fields": "Id," + ",".join(roll_cols), "limit": PAGE_SIZE},
     )
 
     create_column(inventory.table_id, Column("extra", "JSON").as_dict())
 
-    for record in records:
-        _id = record["Id"]
-        if (comment := record["comments"]) is not None and "IP" in comment:
-            comment = comment.split("\n")
-            ip = [x for x in comment if "IP" in x]
-            assert len(ip) == 1
-
-            ip = ip[0].split(":")[-1].strip()
-            assert ip.count(".") == 3
-
-        extra = {k: v for k, v in record.items() if k != "Id"}
-        extra["IP"] = ip
-        out = {"Id": _id, "extra": extra}
-
-        resp = httpx.patch(
-            f"{CONFIG.nocodb_url}/api/v2/tables/{inventory.table_id}/records",
-            headers={
-                "xc-token": CONFIG.nocodb_token,
-                "Content-Type": "application/json",
-            },
-            json=out,
-        )
+    def updates():
+        for record in records:
+            ip = None
+            if (comment := record["comments"]) is not None and "IP" in comment:
+                comment = comment.split("\n")
+                ip = [x for x in comment if "IP" in x]
+                assert len(ip) == 1
+
+                ip = ip[0].split(":")[-1].strip()
+                assert ip.count(".") == 3
 
-        check_resp_status_code(resp)
+            extra = {k: v for k, v in record.items() if k != "Id"}
+            extra["IP"] = ip
+            yield {"Id": record["Id"], "extra": extra}
+
+    bulk_patch(inventory.table_id, updates())
 
     for column in roll_cols:
-        delete_column(inventory[column].column_id)
+        delete_column(col_by_name[column].column_id)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    base_schema = get_base_schema()
+    delete_unused_tables(base_schema)
+    fix_stations_table(base_schema)
+    fix_inventory_table(base_schema)
+
+
+if __name__ == "__main__":
+    main()
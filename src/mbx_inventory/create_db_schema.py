@@ -1,11 +1,26 @@
+import atexit
+import functools
 import httpx
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal, Any
 from .schemas import Table, BaseSchema, Column
 
+MAX_CONCURRENCY = 8
+
+
+@functools.cache
+def nocodb_client(nocodb_url: str, nocodb_token: str) -> httpx.Client:
+    client = httpx.Client(
+        base_url=nocodb_url,
+        headers={"xc-token": nocodb_token, "Content-Type": "application/json"},
+    )
+    atexit.register(client.close)
+    return client
+
 
 def check_resp_status_code(resp) -> httpx.Response:
     if resp.status_code != 200:
-        raise httpx.RequestError(f"Error while running {resp.request}:\n{resp.json()}")
+        raise httpx.RequestError(f"Error while running {resp.request}:\n{resp.text}")
 
     return resp
 
@@ -14,10 +29,7 @@ def get_nocodb_bases(
     nocodb_token: str,
     nocodb_url: str = "http://loclahost:8080",
 ) -> httpx.Response:
-    resp = httpx.get(
-        f"{nocodb_url}/api/v2/meta/bases",
-        headers={"xc-token": nocodb_token, "Content-Type": "application/json"},
-    )
+    resp = nocodb_client(nocodb_url, nocodb_token).get("/api/v2/meta/bases")
 
     resp = check_resp_status_code(resp)
     return resp
@@ -28,10 +40,9 @@ def create_mesonet_base(
     nocodb_url: str = "http://localhost:8080",
     db_base_name: str = "Mesonet",
 ) -> str:
-    resp = httpx.post(
-        f"{nocodb_url}/api/v2/meta/bases",
+    resp = nocodb_client(nocodb_url, nocodb_token).post(
+        "/api/v2/meta/bases",
         json={"title": db_base_name, "type": "database", "external": False},
-        headers={"xc-token": nocodb_token, "Content-Type": "application/json"},
     )
 
     resp = check_resp_status_code(resp)
@@ -48,9 +59,8 @@ def create_base_tables(
     nocodb_url: str = "http://localhost:8080",
 ) -> list[Table]:
     for table in tables:
-        resp = httpx.post(
-            f"{nocodb_url}/api/v2/meta/bases/{base_id}/tables",
-            headers={"xc-token": nocodb_token, "Content-Type": "application/json"},
+        resp = nocodb_client(nocodb_url, nocodb_token).post(
+            f"/api/v2/meta/bases/{base_id}/tables",
             json=table.build_request_json(),
         )
 
@@ -58,19 +68,17 @@ def create_base_tables(
         resp_json = resp.json()
         table.table_id = resp_json["id"]
 
+        by_name = {}
+        for x in resp_json["columns"]:
+            by_name.setdefault(x["column_name"], []).append(x)
+
         for column in table.columns:
-            _id = [
-                x
-                for x in resp_json["columns"]
-                if x["column_name"] == column.column_name
-            ]
+            _id = by_name.get(column.column_name, [])
             if len(_id) != 1:
                 raise ValueError(
                     f"Incorrect number of columns matching {column.column_name}"
                 )
-            else:
-                _id = _id[0]
-            column.column_id = _id["id"]
+            column.column_id = _id[0]["id"]
 
     return tables
 
@@ -83,12 +91,8 @@ def find_foreign_column_id(
     nocodb_token: str,
 ) -> BaseSchema:
     target_table = base_schema[table_name]
-    resp = httpx.get(
-        f"{nocodb_url}/api/v2/meta/tables/{target_table.table_id}",
-        headers={
-            "xc-token": nocodb_token,
-            "Content-Type": "application/json",
-        },
+    resp = nocodb_client(nocodb_url, nocodb_token).get(
+        f"/api/v2/meta/tables/{target_table.table_id}"
     )
 
     target_column = []
@@ -110,7 +114,7 @@ def find_foreign_column_id(
 
     target_column = target_column[0]
 
-    base_schema[table_name].columns.append(
+    target_table.columns.append(
         Column(column_name, "Links", column_id=target_column["id"])
     )
     return base_schema
@@ -137,12 +141,8 @@ def populate_relationships_lookups_formulas(
                 columns = table.formulas
 
         for col in columns:
-            resp = httpx.post(
-                f"{nocodb_url}/api/v2/meta/tables/{table.table_id}/columns",
-                headers={
-                    "xc-token": nocodb_token,
-                    "Content-Type": "application/json",
-                },
+            resp = nocodb_client(nocodb_url, nocodb_token).post(
+                f"/api/v2/meta/tables/{table.table_id}/columns",
                 json=col.as_dict(),
             )
             resp = check_resp_status_code(resp)
@@ -178,12 +178,8 @@ def create_primary_columns(
     for table in base_schema.tables:
         for column in table.columns:
             if column.is_primary:
-                resp = httpx.post(
-                    f"{nocodb_url}/api/v2/meta/columns/{column.column_id}/primary",
-                    headers={
-                        "xc-token": nocodb_token,
-                        "Content-Type": "application/json",
-                    },
+                resp = nocodb_client(nocodb_url, nocodb_token).post(
+                    f"/api/v2/meta/columns/{column.column_id}/primary"
                 )
 
                 check_resp_status_code(resp)
@@ -193,10 +189,7 @@ def create_primary_columns(
 def list_bases(
     nocodb_token: str, nocodb_url: str = "http://localhost:8080"
 ) -> list[dict[str, Any]]:
-    resp = httpx.get(
-        f"{nocodb_url}/api/v2/meta/bases",
-        headers={"xc-token": nocodb_token},
-    )
+    resp = nocodb_client(nocodb_url, nocodb_token).get("/api/v2/meta/bases")
 
     resp = check_resp_status_code(resp)
     return resp.json()
@@ -207,9 +200,8 @@ def list_table_columns(
     nocodb_token: str,
     nocodb_url: str = "http://localhost:8080",
 ) -> list[Column]:
-    resp = httpx.get(
-        f"{nocodb_url}/api/v2/meta/tables/{table_id}",
-        headers={"xc-token": nocodb_token},
+    resp = nocodb_client(nocodb_url, nocodb_token).get(
+        f"/api/v2/meta/tables/{table_id}"
     )
 
     resp = check_resp_status_code(resp)
@@ -228,16 +220,21 @@ def list_table_columns(
 def create_tables_from_base(
     base_id: str, nocodb_token: str, nocodb_url: str = "http://localhost:8080"
 ) -> list[Table]:
-    resp = httpx.get(
-        f"{nocodb_url}/api/v2/meta/bases/{base_id}/tables",
-        headers={"xc-token": nocodb_token},
+    resp = nocodb_client(nocodb_url, nocodb_token).get(
+        f"/api/v2/meta/bases/{base_id}/tables"
     )
 
     resp = check_resp_status_code(resp)
-    tables = []
-    for table in resp.json()["list"]:
-        columns = list_table_columns(table["id"], nocodb_token, nocodb_url)
+    table_list = resp.json()["list"]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+        all_columns = executor.map(
+            lambda table: list_table_columns(table["id"], nocodb_token, nocodb_url),
+            table_list,
+        )
 
-        tables.append(Table(table["title"], columns=columns, table_id=table["id"]))
+        tables = [
+            Table(table["title"], columns=columns, table_id=table["id"])
+            for table, columns in zip(table_list, all_columns)
+        ]
 
     return tables
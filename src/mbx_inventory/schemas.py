@@ -6,7 +6,7 @@ from pathlib import Path
 import json
 
 
-@dataclass
+@dataclass(slots=True)
 class Column:
     column_name: str
     uidt: str
@@ -30,7 +30,7 @@ class Column:
         return items
 
 
-@dataclass
+@dataclass(slots=True)
 class Table:
     # TODO: Refactor to only have one columns attribute rather than relationships,
     # lookups, etc.
@@ -62,7 +62,7 @@ class Table:
         raise KeyError(f"Column with name {key} is not present in {self.table_name}.")
 
 
-@dataclass
+@dataclass(slots=True)
 class BaseSchema:
     base_id: str
     tables: list[Table]
@@ -102,8 +102,7 @@ class BaseSchema:
 
     @classmethod
     def load(cls, pth: Path) -> BaseSchema:
-        with pth.open() as json_file:
-            data = json.load(json_file)
+        data = json.loads(pth.read_bytes())
 
         tables = []
         for table in data["tables"]: